@@ -1,7 +1,8 @@
-import os, json, joblib, numpy as np, pandas as pd
+import os, json, asyncio, collections, contextlib, logging, tempfile, joblib, numpy as np, pandas as pd
+import pyarrow as pa, pyarrow.parquet as pq
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.encoders import jsonable_encoder
 from typing import Dict, Any, List
 from api.schemas import PredictPayload
@@ -26,9 +27,13 @@ FEATURE_INFO = {
 
 ART_DIR = os.getenv("ARTIFACTS_DIR", "artifacts")
 MODEL_PATH = os.path.join(ART_DIR, "model.pkl")
+ONNX_PATH = os.path.join(ART_DIR, "model.onnx")
 FEATURES_PATH = os.path.join(ART_DIR, "feature_list.json")
 METRICS_PATH = os.path.join(ART_DIR, "metrics.json")
-SAMPLE_PATH = os.path.join(ART_DIR, "sample_inputs.csv")
+SAMPLE_PATH = os.path.join(ART_DIR, "sample_inputs.parquet")
+INFER_LOG_DIR = os.path.join(ART_DIR, "infer_log")
+
+log = logging.getLogger("uvicorn.error")
 
 app = FastAPI(title="Starling API", version="0.2.0")
 
@@ -37,25 +42,210 @@ app.add_middleware(
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
 
+# Loaded at import: with gunicorn --preload (api/start.sh) this happens once in the master and workers share the pages
+# copy-on-write. The master has then used OpenMP, so preloaded workers (PRELOADED=1) call the booster with
+# num_threads=1 (LightGBM FAQ: forked children can hang when re-entering OpenMP); plain uvicorn keeps the default.
 model = joblib.load(MODEL_PATH)
 FEATURES = json.load(open(FEATURES_PATH))
 METRICS = json.load(open(METRICS_PATH))
 LABELS = METRICS["labels"]
+# Raw LightGBM booster: takes numpy directly, skipping the sklearn wrapper's DataFrame checks
+BOOSTER = model.booster_
+FEATURE_TUPLE = tuple(FEATURES)
+LABELS_TUPLE = tuple(LABELS)
+_NFEAT = len(FEATURE_TUPLE)
 
 # Optional SHAP explainer
 explainer = None
 try:
     import shap
-    explainer = shap.TreeExplainer(model)
+    explainer = shap.TreeExplainer(model, feature_perturbation="tree_path_dependent")
 except Exception:
     explainer = None
 
+# Optional compiled forest (nvForest/FIL); the joblib model stays around for SHAP and as fallback.
+# Loaded per worker at startup (not at import) so nothing GPU/thread-backed is created before a fork.
+FM = None
+
+def load_compiled_forest():
+    global FM
+    try:
+        import nvforest
+    except ImportError:
+        return
+    try:
+        # nvForest reads LightGBM via its text model format, so go through the booster rather than the sklearn wrapper
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.txt")
+            BOOSTER.save_model(path)
+            FM = nvforest.load_model(path, model_type="lightgbm", device="auto")
+        FM.optimize()
+    except Exception as e:
+        log.warning("nvForest backend unavailable, falling back: %s", e)
+        FM = None
+
+# Optional ONNX Runtime session over the model.onnx exported by train.py (also created per worker at startup)
+SESS = None
+
+def load_onnx_session():
+    global SESS
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return
+    if not os.path.exists(ONNX_PATH):
+        return
+    try:
+        so = ort.SessionOptions()
+        # share the cores between server workers (api/start.sh exports WORKERS)
+        so.intra_op_num_threads = max(1, (os.cpu_count() or 1) // int(os.getenv("WORKERS", "1")))
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in ort.get_available_providers()]
+        SESS = ort.InferenceSession(ONNX_PATH, sess_options=so, providers=providers)
+    except Exception as e:
+        log.warning("ONNX Runtime backend unavailable, falling back: %s", e)
+        SESS = None
+
+BOOSTER_KW: Dict[str, Any] = {"num_iteration": BOOSTER.best_iteration}
+
+@app.on_event("startup")
+def load_backends():
+    if os.getenv("PRELOADED") == "1":
+        BOOSTER_KW["num_threads"] = 1
+    load_compiled_forest()
+    load_onnx_session()
+    backend = "nvforest" if FM is not None else "onnxruntime" if SESS is not None else "lightgbm"
+    log.info("Inference backend: %s", backend)
+
+def predict_proba(X: np.ndarray) -> np.ndarray:
+    if FM is not None:
+        return np.asarray(FM.predict_proba(np.asarray(X, dtype=np.float32)))
+    if SESS is not None:
+        return SESS.run(None, {"input": X.astype(np.float32)})[1]
+    return BOOSTER.predict(X, **BOOSTER_KW)
+
+# Micro-batching: /predict enqueues rows, one worker flushes them into a single predict_proba call;
+# rows that asked for ?explain=1 then share a single SHAP call
+MAX_BATCH = 64
+BATCH_WINDOW_S = 0.005
+PREDICT_TIMEOUT_S = 30.0
+
+def shap_contribs(X: np.ndarray, probs: np.ndarray, rows: List[int]) -> Dict[int, np.ndarray]:
+    # SHAP values of each row's top class, best-effort; rows missing from the result fall back to gain importances
+    if explainer is None or not rows:
+        return {}
+    try:
+        sv = explainer.shap_values(X[rows])
+        out = {}
+        for r, (i, k) in enumerate(zip(rows, probs[rows].argmax(axis=1).tolist())):
+            if isinstance(sv, list):
+                out[i] = sv[k][r]
+            else:
+                out[i] = sv[r, :, k] if sv.ndim == 3 else sv[r]
+        return out
+    except Exception:
+        return {}
+
+# SHAP runs as its own task so the worker can move on to the next batch meanwhile
+_SHAP_TASKS = set()
+
+async def _explain(batch: list, X: np.ndarray, probs: np.ndarray, rows: List[int]):
+    contribs = await asyncio.to_thread(shap_contribs, X, probs, rows)
+    for i in rows:
+        fut = batch[i][2]
+        if not fut.done():
+            fut.set_result((probs[i], contribs.get(i)))
+
+async def _next_batch(loop, queue: asyncio.Queue) -> list:
+    batch = [await queue.get()]
+    deadline = loop.time() + BATCH_WINDOW_S
+    while len(batch) < MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout=timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def _batch_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = []
+        try:
+            batch = await _next_batch(loop, queue)
+            X = np.vstack([vec for vec, _, _ in batch])
+            # inference runs in a thread so the event loop keeps serving other routes
+            probs = await asyncio.to_thread(predict_proba, X)
+            explain_rows = []
+            for i, (_, explain, fut) in enumerate(batch):
+                if explain:
+                    explain_rows.append(i)
+                elif not fut.done():  # client may have gone away
+                    fut.set_result((probs[i], None))
+            if explain_rows:
+                task = asyncio.create_task(_explain(batch, X, probs, explain_rows))
+                _SHAP_TASKS.add(task)
+                task.add_done_callback(_SHAP_TASKS.discard)
+        except Exception as e:
+            # never let the worker die: fail this batch and keep serving
+            log.exception("Batch inference failed")
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+@app.on_event("startup")
+async def start_batch_worker():
+    # queue is created here so it belongs to the serving event loop
+    app.state.predict_queue = asyncio.Queue()
+    app.state.batch_worker = asyncio.create_task(_batch_worker(app.state.predict_queue))
+
+@app.on_event("shutdown")
+async def stop_batch_worker():
+    app.state.batch_worker.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app.state.batch_worker
+
+# Inference log: rows buffer in memory and are flushed to a Parquet dataset (hive-partitioned by pred_label) in one write
+LOG_FLUSH_S = 5.0
+LOG_BUF = collections.deque(maxlen=10_000)
+
+def flush_infer_log():
+    rows = []
+    while LOG_BUF:
+        rows.append(LOG_BUF.popleft())
+    if not rows:
+        return
+    try:
+        pq.write_to_dataset(pa.Table.from_pylist(rows), root_path=INFER_LOG_DIR, partition_cols=["pred_label"])
+    except Exception as e:
+        log.warning("Dropped %d inference log rows: %s", len(rows), e)  # logging is best-effort
+
+async def _log_flusher():
+    while True:
+        await asyncio.sleep(LOG_FLUSH_S)
+        await asyncio.to_thread(flush_infer_log)
+
+@app.on_event("startup")
+async def start_log_flusher():
+    app.state.log_flusher = asyncio.create_task(_log_flusher())
+
+@app.on_event("shutdown")
+async def final_log_flush():
+    # stop the periodic flusher first so it can't drain concurrently with the final flush
+    app.state.log_flusher.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app.state.log_flusher
+    flush_infer_log()
+
+_get = dict.get
+
+def _coerce(v: Any) -> float:
+    return np.nan if v is None or v == "" else float(v)
+
 def to_vector(d: Dict[str, Any]) -> np.ndarray:
-    vals = []
-    for f in FEATURES:
-        v = d.get(f, None)
-        vals.append(np.nan if v is None or v == "" else float(v))
-    return np.array(vals, dtype=float).reshape(1, -1)
+    return np.fromiter((_coerce(_get(d, f)) for f in FEATURE_TUPLE), dtype=np.float64, count=_NFEAT).reshape(1, -1)
 
 @app.get("/metadata")
 def metadata():
@@ -71,13 +261,13 @@ def metadata():
 @app.get("/metrics_full")
 def metrics_full():
     # Full metrics for charts (ROC/PR/calibration, confusion matrix, importances)
-    return JSONResponse(content=jsonable_encoder(METRICS))
+    return ORJSONResponse(content=METRICS)
 
 @app.get("/echo-sample")
 def echo_sample():
     if not os.path.exists(SAMPLE_PATH):
-        raise HTTPException(404, "sample_inputs.csv not found")
-    df = pd.read_csv(SAMPLE_PATH)
+        raise HTTPException(404, "sample_inputs.parquet not found")
+    df = pd.read_parquet(SAMPLE_PATH)
     row = df.iloc[0]
     features = {f: (None if pd.isna(row.get(f)) else float(row.get(f))) for f in FEATURES}
     payload = {"features": features}
@@ -86,16 +276,21 @@ def echo_sample():
     return JSONResponse(content=jsonable_encoder(payload))
 
 @app.post("/predict")
-def predict(payload: PredictPayload):
+async def predict(payload: PredictPayload, explain: bool = False):
     x = to_vector(payload.features)
+    fut = asyncio.get_running_loop().create_future()
+    await app.state.predict_queue.put((x, explain, fut))
     try:
-        proba_vec = model.predict_proba(pd.DataFrame(x, columns=FEATURES))[0]
+        proba_vec, contrib = await asyncio.wait_for(fut, timeout=PREDICT_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "Prediction timed out")
     except Exception as e:
         raise HTTPException(400, str(e))
 
     # Top class + confidence stats
-    order = np.argsort(-proba_vec)
-    top_idx, second_idx = int(order[0]), int(order[1])
+    top_idx, second_idx = np.argpartition(-proba_vec, 1)[:2].tolist()
+    if proba_vec[top_idx] < proba_vec[second_idx]:
+        top_idx, second_idx = second_idx, top_idx
     top_lab, second_lab = LABELS[top_idx], LABELS[second_idx]
     top_p, second_p = float(proba_vec[top_idx]), float(proba_vec[second_idx])
     margin = float(top_p - second_p)
@@ -104,22 +299,21 @@ def predict(payload: PredictPayload):
     th = float(METRICS.get("recommended_threshold", 0.5))
     accepted = bool(top_p >= th and margin >= 0.05)  # margin rule is cheap & effective
 
-    # SHAP per-sample (best-effort)
-    top_contrib = []
-    try:
-        if explainer is not None:
-            sv = explainer.shap_values(pd.DataFrame(x, columns=FEATURES))
-            contrib = sv[top_idx][0] if isinstance(sv, list) else sv[0]
-            pairs = sorted(zip(FEATURES, contrib), key=lambda t: abs(t[1]), reverse=True)[:5]
-            top_contrib = [{"feature": f, "shap": float(v), "value": payload.features.get(f, None)} for f,v in pairs]
-    except Exception:
+    # SHAP per-sample when requested via ?explain=1 (computed in the batch worker), else global gain
+    if contrib is not None:
+        abs_c = np.abs(contrib)
+        k = min(5, len(abs_c))
+        top5 = np.argpartition(-abs_c, k - 1)[:k]
+        top5 = top5[np.argsort(-abs_c[top5])]
+        top_contrib = [{"feature": FEATURES[j], "shap": float(contrib[j]), "value": payload.features.get(FEATURES[j], None)} for j in top5.tolist()]
+    else:
         fi = METRICS.get("feature_importances_gain", {})
         pairs = sorted([(f, float(fi.get(f, 0.0)), payload.features.get(f, None)) for f in FEATURES], key=lambda t: t[1], reverse=True)[:5]
         top_contrib = [{"feature": f, "importance": imp, "value": val} for f,imp,val in pairs]
 
     out = {
         "label": top_lab,
-        "probs": {LABELS[i]: float(proba_vec[i]) for i in range(len(LABELS))},
+        "probs": dict(zip(LABELS_TUPLE, proba_vec.tolist())),
         "decision": {
             "accepted": accepted,
             "reason": "above_threshold_and_margin" if accepted else "low_confidence",
@@ -131,43 +325,32 @@ def predict(payload: PredictPayload):
         "top_factors": top_contrib
     }
 
-    # (Optional) lightweight inference log for your demo
-    try:
-        log_row = {
-            **{f: payload.features.get(f, None) for f in FEATURES},
-            "pred_label": top_lab, "top_p": top_p, "margin": margin, "accepted": accepted
-        }
-        log_path = os.path.join(ART_DIR, "infer_log.csv")
-        pd.DataFrame([log_row]).to_csv(log_path, mode="a", index=False, header=not os.path.exists(log_path))
-    except Exception:
-        pass
+    # (Optional) lightweight inference log for your demo; features logged as parsed floats so the Parquet schema stays stable
+    LOG_BUF.append({
+        **dict(zip(FEATURES, x[0].tolist())),
+        "pred_label": top_lab, "top_p": top_p, "margin": margin, "accepted": accepted
+    })
 
     return out
 
 
-@app.post("/batch_predict")
+@app.post("/batch_predict", response_class=ORJSONResponse)
 def batch_predict(rows: List[Dict[str, Any]]):
     if not isinstance(rows, list) or len(rows) == 0:
         raise HTTPException(400, "Provide a non-empty JSON array of {features:{...}} or raw feature dicts.")
     # accept either [{features:{...}}, {...}] formats; normalize
-    cleaned = []
-    for r in rows:
-        feats = r.get("features", r)
-        arr = []
-        for f in FEATURES:
-            v = feats.get(f, None)
-            arr.append(np.nan if v is None or v == "" else float(v))
-        cleaned.append(arr)
-    X = pd.DataFrame(np.array(cleaned), columns=FEATURES)
-    probs = model.predict_proba(X)
+    feats_list = [r.get("features", r) for r in rows]
+    n = len(feats_list)
+    X = np.empty((n, _NFEAT), dtype=np.float64)
+    for j, f in enumerate(FEATURE_TUPLE):
+        X[:, j] = np.fromiter((_coerce(_get(fs, f)) for fs in feats_list), dtype=np.float64, count=n)
+    probs = predict_proba(X)
     preds = probs.argmax(axis=1)
-    out = []
-    for i in range(len(rows)):
-        out.append({
-            "label": LABELS[int(preds[i])],
-            "probs": {LABELS[j]: float(probs[i,j]) for j in range(len(LABELS))}
-        })
-    return out
+    # column-oriented: one label list + one prob list per class (zip on the client)
+    return {
+        "labels": [LABELS[i] for i in preds.tolist()],
+        "probs": {LABELS[j]: probs[:, j].round(6).tolist() for j in range(len(LABELS))}
+    }
 
 @app.get("/health")
 def health():
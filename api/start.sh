@@ -0,0 +1,4 @@
+export WORKERS=${WORKERS:-4}
+# tells api/main.py the model was loaded before fork (single-threaded LightGBM in workers)
+export PRELOADED=1
+gunicorn api.main:app -w "$WORKERS" -k uvicorn.workers.UvicornWorker --preload --bind "0.0.0.0:${PORT:-8081}"
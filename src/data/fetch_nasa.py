@@ -1,4 +1,4 @@
-import os, io, requests, pandas as pd
+import os, requests, pandas as pd
 
 TAP = "https://exoplanetarchive.ipac.caltech.edu/TAP/sync"
 OUTDIR = "artifacts/data"
@@ -47,13 +47,15 @@ FROM toi
 """
 
 def fetch(query: str, out_csv: str):
-    r = requests.get(TAP, params={"query": query, "format": "csv"}, timeout=120)
-    try:
-        r.raise_for_status()
-    except Exception:
-        print("TAP returned an error:\n", r.text[:1000])
-        raise
-    df = pd.read_csv(io.StringIO(r.text), comment="#", encoding="utf-8-sig")
+    # stream the body straight into the parser instead of buffering r.text
+    with requests.get(TAP, params={"query": query, "format": "csv"}, timeout=120, stream=True) as r:
+        try:
+            r.raise_for_status()
+        except Exception:
+            print("TAP returned an error:\n", r.text[:1000])
+            raise
+        r.raw.decode_content = True
+        df = pd.read_csv(r.raw, comment="#", encoding="utf-8-sig")
     df.to_csv(out_csv, index=False)
     print(f"Wrote {out_csv} rows: {len(df)}")
 
@@ -1,5 +1,7 @@
+import os
 import pandas as pd
 import numpy as np
+from typing import List, Optional
 
 FEATURES = [
     "period","duration","depth","impact","prad","insol","teq",
@@ -34,9 +36,22 @@ def load_and_merge(koi_path: str, toi_path: str):
 
     # Keep only rows with a valid label
     df = df[df["label"].isin(LABELS)].copy()
+    df["label"] = pd.Categorical(df["label"], categories=LABELS, ordered=True)
+    df["mission"] = df["mission"].astype("category")
 
-    # Cast numeric
+    # Cast numeric. downcast="float" only yields float32 for a column whose values all survive the cast within
+    # to_numeric's absolute tolerance; other columns stay float64, so dtypes are per-column and data-dependent.
     for c in FEATURES:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
+        df[c] = pd.to_numeric(df[c], errors="coerce", downcast="float")
 
     return df, FEATURES, LABELS
+
+def load_infer_log(root: Optional[str] = None, columns: Optional[List[str]] = None, pred_label: Optional[str] = None):
+    # API inference log (Parquet, hive-partitioned by pred_label); the label filter prunes partitions
+    import pyarrow.dataset as ds  # only needed here, keep load_and_merge free of pyarrow
+    if root is None:
+        root = os.path.join(os.getenv("ARTIFACTS_DIR", "artifacts"), "infer_log")
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+    cols = columns if columns is not None else FEATURES + ["pred_label"]
+    flt = (ds.field("pred_label") == pred_label) if pred_label is not None else None
+    return dataset.to_table(columns=cols, filter=flt).to_pandas()
@@ -1,75 +1,108 @@
-import argparse, json, os, joblib, numpy as np, pandas as pd
+import argparse, json, os, joblib, orjson, numpy as np, pandas as pd
 from itertools import product
+from joblib import Parallel, delayed
 from sklearn.model_selection import StratifiedKFold, train_test_split
 from sklearn.metrics import f1_score, precision_recall_curve, average_precision_score, roc_auc_score, roc_curve, confusion_matrix
 from lightgbm import LGBMClassifier
 from lightgbm.callback import log_evaluation
+from numba import njit, prange
 from src.data.harmonize import load_and_merge, FEATURES, LABELS
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _top_class(y_true, y_prob):
+    # fused max + argmax + correctness per row
+    n, k = y_prob.shape
+    top = np.empty(n)
+    hit = np.empty(n, dtype=np.int64)
+    for i in prange(n):
+        best, p = 0, y_prob[i, 0]
+        for j in range(1, k):
+            if y_prob[i, j] > p:
+                best, p = j, y_prob[i, j]
+        top[i] = p
+        hit[i] = 1 if best == y_true[i] else 0
+    return top, hit
+
+@njit(cache=True)
+def _numba_ece(y_true, y_prob, n_bins):
+    top, hit = _top_class(y_true, y_prob)
+    bin_count = np.zeros(n_bins, dtype=np.int64)
+    bin_conf = np.zeros(n_bins)
+    bin_acc = np.zeros(n_bins)
+    for i in range(top.shape[0]):
+        b = min(max(int(top[i] * n_bins), 0), n_bins - 1)  # last bin includes 1.0
+        bin_count[b] += 1
+        bin_conf[b] += top[i]
+        bin_acc[b] += hit[i]
+    ece = 0.0
+    for b in range(n_bins):
+        if bin_count[b] > 0:
+            ece += bin_count[b] / top.shape[0] * abs(bin_acc[b] / bin_count[b] - bin_conf[b] / bin_count[b])
+    return ece, bin_count, bin_conf, bin_acc
+
 def ece_multiclass(y_true, y_prob, n_bins=10):
     # top-class calibration: place max prob into bins and see accuracy per bin
-    top_prob = y_prob.max(axis=1)
-    top_pred = y_prob.argmax(axis=1)
-    correct = (top_pred == y_true).astype(int)
-    bins = np.linspace(0,1,n_bins+1)
-    mids, accs, confs, counts = [], [], [], []
-    ece = 0.0
-    for i in range(n_bins):
-        lo, hi = bins[i], bins[i+1]
-        mask = (top_prob >= lo) & (top_prob < hi if i < n_bins-1 else top_prob <= hi)
-        if mask.sum()==0: continue
-        mids.append((lo+hi)/2)
-        conf = float(top_prob[mask].mean())
-        acc = float(correct[mask].mean())
-        confs.append(conf); accs.append(acc); counts.append(int(mask.sum()))
-        ece += (mask.mean()) * abs(acc - conf)
-    return float(ece), {"bin_mid": mids, "acc": accs, "conf": confs, "count": counts}
+    ece, counts, conf_sum, acc_sum = _numba_ece(np.ascontiguousarray(y_true, dtype=np.int64),
+                                                np.ascontiguousarray(y_prob, dtype=np.float64), n_bins)
+    nz = np.flatnonzero(counts)
+    mids = ((nz + 0.5) / n_bins).tolist()
+    confs = (conf_sum[nz] / counts[nz]).tolist()
+    accs = (acc_sum[nz] / counts[nz]).tolist()
+    return float(ece), {"bin_mid": mids, "acc": accs, "conf": confs, "count": counts[nz].tolist()}
 
 def curves_ovr(y_true, y_prob, labels):
     # one-vs-rest ROC & PR points for plotting
     roc = {}; pr = {}; auc = {}
-    y_true_oh = np.eye(len(labels))[y_true]
     for k, lab in enumerate(labels):
-        fpr, tpr, _ = roc_curve(y_true_oh[:,k], y_prob[:,k])
-        prec, rec, _ = precision_recall_curve(y_true_oh[:,k], y_prob[:,k])
+        y_k = (y_true == k).astype(np.int8)
+        fpr, tpr, _ = roc_curve(y_k, y_prob[:,k])
+        prec, rec, _ = precision_recall_curve(y_k, y_prob[:,k])
         try:
-            auc_k = roc_auc_score(y_true_oh[:,k], y_prob[:,k])
+            auc_k = roc_auc_score(y_k, y_prob[:,k])
         except Exception:
             auc_k = float("nan")
         roc[lab] = {"fpr": fpr.tolist(), "tpr": tpr.tolist()}
         pr[lab]  = {"precision": prec.tolist(), "recall": rec.tolist(),
-                    "ap": float(average_precision_score(y_true_oh[:,k], y_prob[:,k]))}
+                    "ap": float(average_precision_score(y_k, y_prob[:,k]))}
         auc[lab] = float(auc_k)
     return roc, pr, auc
 
-def threshold_for_precision(y_true, y_prob, target_prec=0.90):
-    # choose a global abstain threshold on top-class prob to achieve ~target precision
-    order = np.argsort(-y_prob.max(axis=1))
-    probs = y_prob.max(axis=1)[order]
-    preds = y_prob.argmax(axis=1)[order]
-    correct = (preds == y_true[order]).astype(int)
-    cum_tp = np.cumsum(correct)
-    cum_pp = np.arange(1, len(correct)+1)
-    precision = cum_tp / np.maximum(cum_pp,1)
-    idx = np.where(precision >= target_prec)[0]
+def threshold_for_precision(y_true, y_prob, target_prec=0.90, n_bins=1000):
+    # choose a global abstain threshold on top-class prob to achieve ~target precision;
+    # precision is scanned over a histogram of top-class probs instead of a full sort
+    top_prob, correct = _top_class(np.ascontiguousarray(y_true, dtype=np.int64),
+                                   np.ascontiguousarray(y_prob, dtype=np.float64))
+    bins = np.clip((top_prob * n_bins).astype(np.int32), 0, n_bins - 1)
+    tp = np.bincount(bins, weights=correct, minlength=n_bins)
+    pp = np.bincount(bins, minlength=n_bins)
+    cum_tp = tp[::-1].cumsum()
+    cum_pp = pp[::-1].cumsum()
+    precision = cum_tp / np.maximum(cum_pp, 1)
+    idx = np.flatnonzero((precision >= target_prec) & (cum_pp > 0))
     if len(idx)==0:  # fallback: 0.5
         return 0.5
-    return float(probs[idx[-1]])
+    return float((n_bins - 1 - idx[-1]) / n_bins)
+
+CV_FOLDS = 5
+
+def _fit_fold(X, y, tr, va, params):
+    # each fold gets an equal share of the cores so folds can run side by side
+    params = params | {"n_jobs": max(1, (os.cpu_count() or 1) // CV_FOLDS)}
+    clf = LGBMClassifier(**params)
+    clf.fit(X.iloc[tr], y[tr], eval_set=[(X.iloc[va], y[va])], eval_metric="multi_logloss", callbacks=[log_evaluation(period=0)])
+    pred = clf.predict(X.iloc[va])
+    return f1_score(y[va], pred, average="macro")
 
 def train_eval_once(X, y, params):
-    skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
-    f1s = []
-    for tr, va in skf.split(X, y):
-        clf = LGBMClassifier(**params)
-        clf.fit(X.iloc[tr], y[tr], eval_set=[(X.iloc[va], y[va])], eval_metric="multi_logloss", callbacks=[log_evaluation(period=0)])
-        pred = clf.predict(X.iloc[va])
-        f1s.append(f1_score(y[va], pred, average="macro"))
+    skf = StratifiedKFold(n_splits=CV_FOLDS, shuffle=True, random_state=42)
+    f1s = Parallel(n_jobs=CV_FOLDS, backend="loky")(
+        delayed(_fit_fold)(X, y, tr, va, params) for tr, va in skf.split(X, y)
+    )
     return float(np.mean(f1s)), float(np.std(f1s))
 
 def main(args):
     df, F, L = load_and_merge(args.koi, args.toi)
-    y_map = {l:i for i,l in enumerate(L)}
-    y = df["label"].map(y_map).values
+    y = df["label"].cat.codes.to_numpy(np.int8)  # codes follow L order
     X = df[F].copy()
 
     # ----- tiny hyperparam sweep (fast, robust) -----
@@ -112,13 +145,14 @@ def main(args):
         auc_ovr = float("nan")
     cm = confusion_matrix(yte, pred).tolist()
     
-    cm_np = np.array(cm)
-    pairs = []
-    for i, li in enumerate(L):
-        for j, lj in enumerate(L):
-            if i != j:
-                pairs.append((li, lj, int(cm_np[i, j])))
-    pairs_sorted = sorted(pairs, key=lambda t: t[2], reverse=True)[:5]
+    # top-5 off-diagonal cells (diagonal masked to -1 so it never ranks)
+    m = np.array(cm, dtype=np.int64)
+    K = m.shape[0]
+    np.fill_diagonal(m, -1)
+    flat = m.ravel()
+    n_top = min(5, K * (K - 1))
+    top = np.argsort(-flat, kind="stable")[:n_top]  # stable: ties keep row-major order, as before
+    pairs_sorted = [(L[idx // K], L[idx % K], int(flat[idx])) for idx in top.tolist()]
 
     # curves + calibration
     roc_pts, pr_pts, auc_per_class = curves_ovr(yte, prob, L)
@@ -158,7 +192,21 @@ def main(args):
         shap_global = {}
 
     os.makedirs(args.outdir, exist_ok=True)
-    joblib.dump(clf, os.path.join(args.outdir, "model.pkl"))
+    joblib.dump(clf, os.path.join(args.outdir, "model.pkl"), compress=3)
+    # optional ONNX export for the API's onnxruntime path (probabilities as a plain tensor, no ZipMap);
+    # drop any model.onnx from a previous run first so the API can't serve a stale model next to the new one
+    onnx_path = os.path.join(args.outdir, "model.onnx")
+    if os.path.exists(onnx_path):
+        os.remove(onnx_path)
+    try:
+        import onnxmltools
+        from onnxmltools.convert.common.data_types import FloatTensorType
+        onx = onnxmltools.convert_lightgbm(clf, initial_types=[("input", FloatTensorType([None, len(F)]))],
+                                           target_opset=15, zipmap=False)
+        with open(onnx_path, "wb") as f:
+            f.write(onx.SerializeToString())
+    except Exception as e:
+        print("Skipping ONNX export:", e)
     with open(os.path.join(args.outdir, "feature_list.json"), "w") as f:
         json.dump(F, f)
 
@@ -183,13 +231,13 @@ def main(args):
     "feature_importances_shap": shap_global
     }
 
-    with open(os.path.join(args.outdir, "metrics.json"), "w") as f:
-        json.dump(metrics, f, indent=2)
+    with open(os.path.join(args.outdir, "metrics.json"), "wb") as f:
+        f.write(orjson.dumps(metrics, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
     # sample inputs for UI/API dev (JSON-safe: drop NaNs)
-    sample = Xte.head(5).copy()
-    sample["true_label"] = [L[i] for i in yte[:5]]
-    sample.to_csv(os.path.join(args.outdir, "sample_inputs.csv"), index=False)
+    sample = Xte.head(5).astype(np.float64)  # features may be float32 after harmonize's downcast
+    sample["true_label"] = [L[int(i)] for i in yte[:5]]
+    sample.to_parquet(os.path.join(args.outdir, "sample_inputs.parquet"), compression="zstd", index=False)
 
     print("Saved artifacts to", args.outdir)
     print("CV macro-F1 (mean±std):", round(best["mean_f1"],3), "±", round(best["std_f1"],3))
@@ -49,6 +49,12 @@ export interface PredictResponse {
   }>;
 }
 
+// Column-oriented: labels[i] and probs[label][i] describe row i
+export interface BatchPredictResponse {
+  labels: string[];
+  probs: Record<string, number[]>;
+}
+
 export interface MetricsFull {
   confusion_matrix: number[][];
   roc: Record<string, RocCurve>;
@@ -107,7 +113,7 @@ export async function getEchoSample(): Promise<{
 export async function predict(
   features: Record<string, number>
 ): Promise<PredictResponse> {
-  const res = await fetch(`${API_URL}/predict`, {
+  const res = await fetch(`${API_URL}/predict?explain=1`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({ features }),
@@ -118,7 +124,7 @@ export async function predict(
 
 export async function batchPredict(
   rows: Array<{ features: Record<string, number> }>
-): Promise<PredictResponse[]> {
+): Promise<BatchPredictResponse> {
   const res = await fetch(`${API_URL}/batch_predict`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },